@@ -1,11 +1,45 @@
 #!/usr/local/bin/python3
 
 import json
+import matplotlib
+matplotlib.use('Agg')  # figures are only saved in the report, no display is needed
+import matplotlib.pyplot as plt
 import mne
+import os
+import string
 import warnings
 import numpy as np
 
 
+NO_BAD_CHANNELS_WARNING_MESSAGE = 'No channels are marked as bad. ' \
+                                  'Make sure to check (automatically or visually) for bad channels before ' \
+                                  'running MaxFilter.'
+
+# HTML templates of the report tables
+HTML_TABLE_CSS = """<style type="text/css">
+            table { border-collapse: collapse;}
+            td { text-align: center; border: 1px solid #000000; border-style: dashed; font-size: 15px; }
+        </style>"""
+
+HTML_TABLE_TEMPLATE = string.Template("""<html>
+
+    <head>
+        $css
+    </head>
+
+    <body>
+        <table width="50%" height="80%" border="2px">
+$rows
+        </table>
+    </body>
+
+    </html>""")
+
+HTML_ROW_TEMPLATE = string.Template("""            <tr>
+                <td>$label: $value</td>
+            </tr>""")
+
+
 def maxfilter(raw, calibration_file, cross_talk_file, head_pos_file, destination_file, param_st_duration,
               param_st_correlation, param_int_order, param_ext_order, param_coord_frame, param_regularize,
               param_ignore_ref, param_bad_condition, param_st_fixed, param_st_only, param_skip_by_annotation,
@@ -60,14 +94,13 @@ def maxfilter(raw, calibration_file, cross_talk_file, head_pos_file, destination
     """
 
     # Check if MaxFilter was already applied on the data
-    if raw.info['proc_history']:
-        sss_info = raw.info['proc_history'][0]['max_info']['sss_info']
-        tsss_info = raw.info['proc_history'][0]['max_info']['max_st']
-        if bool(sss_info) or bool(tsss_info) is True:
-            value_error_message = f'You cannot apply MaxFilter if data have been already ' \
-                                  f'processed with Maxwell filtering.'
-            # Raise exception
-            raise ValueError(value_error_message)
+    proc_history = raw.info.get('proc_history')
+    max_info = proc_history[0].get('max_info', {}) if proc_history else {}
+    if max_info.get('sss_info') or max_info.get('max_st'):
+        value_error_message = f'You cannot apply MaxFilter if data have been already ' \
+                              f'processed with Maxwell filtering.'
+        # Raise exception
+        raise ValueError(value_error_message)
 
     # Apply MaxFilter
     raw_maxfilter = mne.preprocessing.maxwell_filter(raw, calibration=calibration_file, cross_talk=cross_talk_file,
@@ -80,59 +113,75 @@ def maxfilter(raw, calibration_file, cross_talk_file, head_pos_file, destination
                                                      skip_by_annotation=param_skip_by_annotation,
                                                      mag_scale=param_mag_scale)
 
-    # Save file
+    # Save file with large buffers to write fewer, bigger data blocks
     if param_st_duration is not None:
-        raw_maxfilter.save("out_dir_maxfilter/raw_tsss.fif", overwrite=True)
+        raw_maxfilter.save("out_dir_maxfilter/raw_tsss.fif", buffer_size_sec=30., fmt='single', overwrite=True,
+                           split_size='2GB')
     else:
-        raw_maxfilter.save("out_dir_maxfilter/raw_sss.fif", overwrite=True)
+        raw_maxfilter.save("out_dir_maxfilter/raw_sss.fif", buffer_size_sec=30., fmt='single', overwrite=True,
+                           split_size='2GB')
 
     return raw_maxfilter
 
 
-def _compute_snr(meg_file):
-    # Compute the SNR
-
-    # select only MEG channels and exclude the bad channels
-    meg_file = meg_file.pick_types(meg=True, exclude='bads')
+def _compute_snr(meg_file, meg_picks):
+    # Compute the SNR on the channels in meg_picks, return it with the number of epochs used
 
     # create fixed length events
     array_events = mne.make_fixed_length_events(meg_file, duration=10)
 
-    # create epochs
-    epochs = mne.Epochs(meg_file, array_events)
+    # create epochs, they are read one at a time from the preloaded raw data
+    epochs = mne.Epochs(meg_file, array_events, picks=meg_picks)
 
-    # mean signal amplitude on each epoch
-    epochs_data = epochs.get_data()
-    mean_signal_amplitude_per_epoch = epochs_data.mean(axis=(1, 2))  # mean on channels and times
+    # accumulate the mean signal amplitude of each epoch and its square, one epoch at a time
+    n_epochs = 0
+    sum_means = 0.
+    sum_squared_means = 0.
+    for epoch_data in epochs:  # epochs rejected while reading are skipped
+        mean_signal_amplitude = epoch_data.mean()  # mean on channels and times
+        sum_means += mean_signal_amplitude
+        sum_squared_means += mean_signal_amplitude * mean_signal_amplitude
+        n_epochs += 1
 
-    # mean across all epochs and its std error
-    mean_final = mean_signal_amplitude_per_epoch.mean()
-    std_error_final = np.std(mean_signal_amplitude_per_epoch, ddof=1) / np.sqrt(
-        np.size(mean_signal_amplitude_per_epoch))
+    # the std error needs at least two epochs (e.g. short recordings or epochs all rejected by annotations)
+    if n_epochs < 2:
+        return np.nan, n_epochs
+
+    # mean across all epochs and its std error, the variance is clamped as the closed form can round below 0
+    mean_final = sum_means / n_epochs
+    variance = max((sum_squared_means - sum_means * mean_final) / (n_epochs - 1), 0.)
+    std_error_final = np.sqrt(variance / n_epochs)
 
     # compute SNR
     snr = mean_final / std_error_final
 
-    return snr
+    return snr, n_epochs
+
 
+def _html_table(rows):
+    # Build an html table with one row per (label, value) pair
+    html_rows = '\n'.join(HTML_ROW_TEMPLATE.substitute(label=label, value=value) for label, value in rows)
+    return HTML_TABLE_TEMPLATE.substitute(css=HTML_TABLE_CSS, rows=html_rows)
 
-def _generate_report(data_file_before, raw_before_preprocessing, raw_after_preprocessing, bad_channels, snr_before, snr_after):
+
+def _generate_report(data_file_before, raw_before_preprocessing, raw_after_preprocessing, meg_picks_before,
+                     meg_picks_after, bad_channels, snr_before, snr_after):
     # Generate a report
 
     # Instance of mne.Report
     report = mne.Report(title='Results Maxfilter', verbose=True)
 
     # Plot MEG signals in temporal domain
-    fig_raw = raw_before_preprocessing.pick(['meg'], exclude='bads').plot(duration=10, scalings='auto', butterfly=False,
-                                                                          show_scrollbars=False, proj=False)
-    fig_raw_maxfilter = raw_after_preprocessing.pick(['meg'], exclude='bads').plot(duration=10, scalings='auto',
-                                                                                   butterfly=False,
-                                                                                   show_scrollbars=False, proj=False)
+    fig_raw = raw_before_preprocessing.plot(duration=10, scalings='auto', order=meg_picks_before, butterfly=False,
+                                            show_scrollbars=False, proj=False, show=False)
+    fig_raw_maxfilter = raw_after_preprocessing.plot(duration=10, scalings='auto', order=meg_picks_after,
+                                                     butterfly=False, show_scrollbars=False, proj=False, show=False)
     # Plot power spectral density
-    fig_raw_psd = raw_before_preprocessing.plot_psd()
-    fig_raw_maxfilter_psd = raw_after_preprocessing.plot_psd()
+    # Average across channels: the report figure is too small to show one trace per channel
+    fig_raw_psd = raw_before_preprocessing.plot_psd(n_fft=1024, picks=meg_picks_before, average=True, show=False)
+    fig_raw_maxfilter_psd = raw_after_preprocessing.plot_psd(n_fft=1024, picks=meg_picks_after, average=True,
+                                                             show=False)
 
-    # Add figures to report
     # Add figures to report
     report.add_figs_to_section(fig_raw, captions='MEG signals before MaxFilter', section='Temporal domain')
     report.add_figs_to_section(fig_raw_maxfilter, captions='MEG signals after MaxFilter', section='Temporal domain')
@@ -141,6 +190,10 @@ def _generate_report(data_file_before, raw_before_preprocessing, raw_after_prepr
     report.add_figs_to_section(fig_raw_maxfilter_psd, captions='Power spectral density after MaxFilter',
                                section='Frequency domain')
 
+    # Figures are rendered into the report, close them to free their memory
+    for fig in (fig_raw, fig_raw_maxfilter, fig_raw_psd, fig_raw_maxfilter_psd):
+        plt.close(fig)
+
     # Put this info in html format
     # Give some info about the file before preprocessing
     sampling_frequency = raw_before_preprocessing.info['sfreq']
@@ -149,59 +202,15 @@ def _generate_report(data_file_before, raw_before_preprocessing, raw_after_prepr
 
     # Put this info in html format
     # Info on data
-    html_text_info = f"""<html>
-
-    <head>
-        <style type="text/css">
-            table {{ border-collapse: collapse;}}
-            td {{ text-align: center; border: 1px solid #000000; border-style: dashed; font-size: 15px; }}
-        </style>
-    </head>
-
-    <body>
-        <table width="50%" height="80%" border="2px">
-            <tr>
-                <td>Input file: {data_file_before}</td>
-            </tr>
-            <tr>
-                <td>Bad channels: {bad_channels}</td>
-            </tr>
-            <tr>
-                <td>Sampling frequency: {sampling_frequency}Hz</td>
-            </tr>
-            <tr>
-                <td>Highpass: {highpass}Hz</td>
-            </tr>
-            <tr>
-                <td>Lowpass: {lowpass}Hz</td>
-            </tr>
-        </table>
-    </body>
-
-    </html>"""
+    html_text_info = _html_table([('Input file', data_file_before),
+                                  ('Bad channels', bad_channels),
+                                  ('Sampling frequency', f'{sampling_frequency}Hz'),
+                                  ('Highpass', f'{highpass}Hz'),
+                                  ('Lowpass', f'{lowpass}Hz')])
 
     # Info on SNR
-    html_text_snr = f"""<html>
-
-    <head>
-        <style type="text/css">
-            table {{ border-collapse: collapse;}}
-            td {{ text-align: center; border: 1px solid #000000; border-style: dashed; font-size: 15px; }}
-        </style>
-    </head>
-
-    <body>
-        <table width="50%" height="80%" border="2px">
-            <tr>
-                <td>SNR before MaxFilter: {snr_before}</td>
-            </tr>
-            <tr>
-                <td>SNR after MaxFilter: {snr_after}</td>
-            </tr>
-        </table>
-    </body>
-
-    </html>"""
+    html_text_snr = _html_table([('SNR before MaxFilter', snr_before),
+                                 ('SNR after MaxFilter', snr_after)])
 
     # Add html to reports
     report.add_htmls_to_section(html_text_info, captions='MEG recording features', section='Info', replace=False)
@@ -214,6 +223,10 @@ def _generate_report(data_file_before, raw_before_preprocessing, raw_after_prepr
 
 def main():
 
+    # Make output directories, also when the script is run without the main wrapper
+    for out_dir in ('out_dir_maxfilter', 'out_dir_report'):
+        os.makedirs(out_dir, exist_ok=True)
+
     # Generate a json.product to display messages on Brainlife UI
     dict_json_product = {'brainlife': []}
 
@@ -221,50 +234,56 @@ def main():
     with open('config.json') as config_json:
         config = json.load(config_json)
 
+    # Empty optional files and st_duration from the Brainlife UI mean None
+    for key in ('crosstalk', 'calibration', 'destination', 'headshape', 'param_st_duration'):
+        if config.get(key) == "":
+            config[key] = None
+
     # Read the files
     data_file = config.pop('fif')
-    raw = mne.io.read_raw_fif(data_file, allow_maxshield=True)
+    raw = mne.io.read_raw_fif(data_file, allow_maxshield=True, preload=True)
 
-    # Read the calibration files
-    if 'crosstalk' in config.keys():
-        cross_talk_file = config.pop('crosstalk')
-    else:
-        cross_talk_file = None
+    # Skip MaxFilter, SNR and report if there are no good MEG channels (e.g. EEG-only data)
+    meg_picks = mne.pick_types(raw.info, meg=True, exclude='bads')
+    if len(meg_picks) == 0:
+        user_warning_message = f'No good MEG channels were found in {data_file}. MaxFilter was not applied.'
+        warnings.warn(user_warning_message)
+        dict_json_product['brainlife'].append({'type': 'warning', 'msg': user_warning_message})
+        with open('product.json', 'w') as outfile:
+            json.dump(dict_json_product, outfile)
+        return
 
-    if 'calibration' in config.keys():
-        calibration_file = config.pop('calibration')
-    else:
-        calibration_file = None
+    # Read the calibration files
+    cross_talk_file = config.pop('crosstalk', None)
+    calibration_file = config.pop('calibration', None)
 
     # Read the run to realign all runs
-    if 'destination' in config.keys():
-        destination_file = config.pop('destination')
-    else:
-        destination_file = None
+    destination_file = config.pop('destination', None)
 
     # Head pos file
-    if 'headshape' in config.keys():
-        head_pos_file = config.pop('headshape')
-        if head_pos_file is not None:  # when App is run locally and "head_position": null in config.json
-            head_pos_file = mne.chpi.read_head_pos(head_pos_file)
-    else:
-        head_pos_file = None
-
-    # Check if param_st_duration is not None
-    if config['param_st_duration'] == "":
-        param_st_duration = None
-    else:
-        param_st_duration = config['param_st_duration']
+    head_pos_file = config.pop('headshape', None)
+    if head_pos_file is not None:  # when App is run locally and "head_position": null in config.json
+        head_pos_file = mne.chpi.read_head_pos(head_pos_file)
 
     # Warning if bad channels are empty
-    if not raw.info['bads']:
-        user_warning_message = f'No channels are marked as bad. ' \
-                               f'Make sure to check (automatically or visually) for bad channels before ' \
-                               f'running MaxFilter.'
+    bad_channels = raw.info['bads']
+    if not bad_channels:
+        warnings.warn(NO_BAD_CHANNELS_WARNING_MESSAGE)
+        dict_json_product['brainlife'].append({'type': 'warning', 'msg': NO_BAD_CHANNELS_WARNING_MESSAGE})
+
+    # Warning if the tSSS parameters make the filtering aggressive or slow
+    param_st_duration = config['param_st_duration']
+    if param_st_duration is not None and 0 < param_st_duration < 4:
+        user_warning_message = f'st_duration is {param_st_duration}s. Short tSSS buffers act as a high-pass ' \
+                               f'filter at {1 / param_st_duration:.2f}Hz, a value of 10s or more is recommended.'
+        warnings.warn(user_warning_message)
+        dict_json_product['brainlife'].append({'type': 'warning', 'msg': user_warning_message})
+    if param_st_duration is not None and head_pos_file is not None and not config['param_st_fixed']:
+        user_warning_message = 'st_fixed is False, tSSS will use all head positions within each buffer, ' \
+                               'which is slower than using the median head position (st_fixed=True).'
         warnings.warn(user_warning_message)
         dict_json_product['brainlife'].append({'type': 'warning', 'msg': user_warning_message})
 
-    bad_channels = raw.info['bads']
     raw_maxfilter = maxfilter(raw, calibration_file, cross_talk_file, head_pos_file, destination_file,
                               param_st_duration, config['param_st_correlation'], config['param_int_order'],
                               config['param_ext_order'], config['param_coord_frame'], config['param_regularize'],
@@ -274,12 +293,22 @@ def main():
     # Success message in product.json
     dict_json_product['brainlife'].append({'type': 'success', 'msg': 'MaxFilter was applied successfully.'})
 
+    # Good MEG channels after MaxFilter, bad channels may have been reconstructed
+    meg_picks_maxfilter = mne.pick_types(raw_maxfilter.info, meg=True, exclude='bads')
+
     # Compute SNR
-    snr_before = _compute_snr(raw)
-    snr_after = _compute_snr(raw_maxfilter)
+    snr_before, n_epochs_before = _compute_snr(raw, meg_picks)
+    snr_after, n_epochs_after = _compute_snr(raw_maxfilter, meg_picks_maxfilter)
+    if min(n_epochs_before, n_epochs_after) < 2:
+        user_warning_message = 'SNR could not be computed: fewer than two epochs (-0.2s to 0.5s windows around ' \
+                               'events spaced 10s apart) are available (recording too short or segments ' \
+                               'rejected by annotations).'
+        warnings.warn(user_warning_message)
+        dict_json_product['brainlife'].append({'type': 'warning', 'msg': user_warning_message})
 
     # Generate a report
-    _generate_report(data_file, raw, raw_maxfilter, bad_channels, snr_before, snr_after)
+    _generate_report(data_file, raw, raw_maxfilter, meg_picks, meg_picks_maxfilter, bad_channels, snr_before,
+                     snr_after)
 
     # Save the dict_json_product in a json file
     with open('product.json', 'w') as outfile: